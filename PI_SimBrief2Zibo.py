@@ -12,15 +12,23 @@ LICENSE file in the root directory of this source tree.
 from __future__ import annotations
 
 import os
+import re
 import json
+import queue
 import threading
 import requests
 
+from functools import lru_cache
+from io import BytesIO
+from itertools import islice
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 from urllib import parse
 from xml.etree import ElementTree as ET
-from datetime import datetime, timedelta
-from time import perf_counter
+from datetime import datetime
+from time import perf_counter, time
 
 try:
     from XPPython3 import xp
@@ -44,10 +52,49 @@ AIRCRAFTS = [
     ('Zibo', 'B737-800X'),
     ('LevelUp', 'LevelUp')
 ]
+ACF_RE = re.compile('|'.join(re.escape(p[1]) for p in AIRCRAFTS))  # any known aircraft identifier in acf path
+ACF_NAMES = {p[1]: p[0] for p in AIRCRAFTS}
 
 # Other parameters
 DEFAULT_SCHEDULE = 15  # positive numbers are seconds, 0 disabled, negative numbers are cycles
+OFP_BACKOFF_MAX = 60  # max seconds between SimBrief queries while no new OFP is found
+POLL_MIN = 0.2  # seconds between checks right after starting a SimBrief query
+POLL_MAX = 2  # seconds between checks while a SimBrief query is still pending
+POLL_BACKOFF = 1.5  # growth factor of the check interval while waiting
 DAYS = 2  # how recent a fp file has to be to be considered
+TIMEOUT = 10  # seconds to wait for a server answer
+DOWNLOAD_CHUNK = 128 * 1024  # bytes written at a time when downloading a file
+WORKERS = 2  # worker threads for async tasks, a SimBrief and a D-ATIS request can run together
+RETRIES = 2  # retries on connection errors and server side temporary failures
+ATIS_CACHE = 8  # wrapped D-ATIS texts kept in memory
+ATIS_TTL = 120  # seconds a D-ATIS answer is reused for the same airport
+ATIS_ERROR_TTL = 30  # seconds a failed D-ATIS request is not repeated
+REQUEST_ID_PROBE = 64 * 1024  # max bytes read looking for the OFP request_id before getting the whole OFP
+DEBUG = False  # verbose logging, keep it off in releases
+
+# OFP parsing
+REQUEST_ID_RE = re.compile(rb'<request_id>([^<]*)</request_id>')
+# last "FL WIND TEMP" group at the end of a LIDO style descent wind line
+DESCENT_WIND_RE = re.compile(r'(\S+)\s+(\S+)\s+(\S+)\s*$')
+# OFP sections not needed by the plugin, dropped while parsing
+OFP_DROP_TAGS = frozenset((
+    'fetch', 'aircraft', 'times', 'impacts', 'crew', 'notams', 'weather', 'sigmets', 'tracks',
+    'database_updates', 'files', 'images', 'links', 'prefile',
+    'vatsim_prefile', 'ivao_prefile', 'pilotedge_prefile', 'poscon_prefile', 'map_data'
+))
+AIRPORT_TAGS = frozenset(('origin', 'destination', 'alternate'))
+AIRPORT_DROP_TAGS = frozenset(('taf', 'notam'))
+
+# OFP weight unit: (factor, unit) to show the weight in the other unit
+WEIGHT_FACTORS = {
+    'kgs': (2.205, 'lbs'),
+    'lbs': (0.4535, 'kgs')
+}
+
+# uplink file plan_html parts, as in LIDO format
+SUMMARY_TAG = '''<div style="line-height:14px;font-size:13px"><pre><!--BKMK///OFP///0--><!--BKMK///Summary and Fuel///1--><b>[ OFP ]\n--------------------------------------------------------------------</b>\nOFP 1\n\n'''
+WIND_TAG = '''<h2 style="page-break-after: always;"> </h2><!--BKMK///Wind Information///1-->--------------------------------------------------------------------\n WIND INFORMATION \nDESCENT\n'''
+WX_TAG = '''<h2 style="page-break-after: always;"> </h2><!--BKMK///Airport WX List///0--><b>[ Airport WX List ]\n--------------------------------------------------------------------</b>\nDestination:\n'''
 
 # widget parameters
 try:
@@ -59,6 +106,18 @@ except NameError:
 DETAILS_WIDTH = 240
 ATIS_WIDTH = DETAILS_WIDTH * 2
 
+# shared HTTP session, its connection pool avoids a new TLS handshake on each poll
+session = requests.Session()
+# retry only connection errors and 502/503/504 with a short backoff, on both secure and unsecure
+# fallback connections, a stalled read or a SSL failure is reported at once (the latter goes to
+# the unsecure fallback); when retries are exhausted the last response is checked as usual
+adapter = HTTPAdapter(max_retries=Retry(
+    total=RETRIES, read=0, other=0, backoff_factor=0.3,
+    status_forcelist=(502, 503, 504), raise_on_status=False
+))
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
 
 def get_unsecure_url(url: str) -> str:
     parsed = parse.urlparse(url)
@@ -66,71 +125,105 @@ def get_unsecure_url(url: str) -> str:
     return parse.urlunparse(parsed)
 
 
-def get_from_url(url: str) -> tuple[bool | requests.Response, str | int | None]:
+def get_from_url(url: str, headers: dict | None = None, stream: bool = False) -> tuple[bool | requests.Response, str | int | None]:
     response = False
     error = None
     try:
-        response = requests.get(url, verify=True)
-    except requests.exceptions.SSLError as e:
-        # change link to unsecure protocol to avoid SSL error in some weird systems
-        print(f" *** connection to {url} had to run in unsecure mode: {e.args[0]}")
         try:
-            link = get_unsecure_url(url)
-            response = requests.get(link)
-        except Exception as e:
-            print(f"*** SimBrief generic error: {e.args[0]}")
-            error = e.args[0]
-    except requests.exceptions.ConnectionError as e:
+            response = session.get(url, headers=headers, stream=stream, verify=True, timeout=TIMEOUT)
+        except requests.exceptions.SSLError as e:
+            # change link to unsecure protocol to avoid SSL error in some weird systems
+            print(f" *** connection to {url} had to run in unsecure mode: {e.args[0]}")
+            response = session.get(get_unsecure_url(url), headers=headers, stream=stream, timeout=TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        # connection errors, timeouts and other request failures, on either link
         print(f"*** SimBrief connection error: {e.args[0]}")
         error = e.args[0]
-    finally:
-        if response:
-            try:
-                response.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                error = response.status_code
-                if response.status_code == 400:
-                    print(f"*** SimBrief Error, probably wrong pilotID")
-                else:
-                    print(f"*** SimBrief connection refused: {response.status_code} - {response.reason}")
+    # a Response is falsy for 4xx/5xx status codes, test its type instead
+    if isinstance(response, requests.Response) and not response.ok:
+        error = response.status_code
+        if response.status_code == 400:
+            print(f"*** SimBrief Error, probably wrong pilotID")
+        else:
+            print(f"*** SimBrief connection refused: {response.status_code} - {response.reason}")
     return response, error
 
 
-class Async(threading.Thread):
-    """Run an asynchronous task on a new thread
+class Async(object):
+    """Run an asynchronous task on one of the plugin worker threads
+
+    Worker threads are started with the first task and kept alive,
+    so each request does not pay for a new thread.
 
     Attributes:
         task (method): Worker method to be called
-        die (threading.Event): Set the flag to end the tasks
+        cancel (threading.Event): Set the flag to skip the task if it has not started yet
         result (): return of the task method
+        elapsed (float): task duration, only measured in DEBUG mode
     """
 
+    tasks = queue.Queue()
+    workers = []
+
     def __init__(self, task, *args, **kwargs):
 
         self.pid = os.getpid()
         self.task = task
         self.cancel = threading.Event()
+        self.done = threading.Event()
         self.kwargs = kwargs
         self.args = args
         self.elapsed = False
         self.result = False
-        threading.Thread.__init__(self)
 
-        self.pending = self.is_alive
+    @classmethod
+    def worker(cls):
+        while True:
+            job = cls.tasks.get()
+            if job is None:
+                # shutdown
+                return
+            if job.cancel.is_set():
+                # stopped before it could start
+                job.done.set()
+            else:
+                job.run()
+
+    @classmethod
+    def shutdown(cls):
+        for _ in cls.workers:
+            cls.tasks.put(None)
+        cls.workers.clear()
+
+    def start(self):
+        if not Async.workers:
+            for i in range(WORKERS):
+                # never keep X-Plane from quitting while waiting for a server
+                t = threading.Thread(target=Async.worker, name=f"{plugin_name}-{i}", daemon=True)
+                t.start()
+                Async.workers.append(t)
+        Async.tasks.put(self)
+
+    def pending(self) -> bool:
+        return not self.done.is_set()
+
+    def join(self, timeout: float | None = None) -> None:
+        self.done.wait(timeout)
 
     def run(self):
-        start = perf_counter()
+        start = perf_counter() if DEBUG else 0
         try:
             self.result = self.task(*self.args, **self.kwargs)
         except Exception as e:
             self.result = e
         finally:
-            self.elapsed = perf_counter() - start
+            if DEBUG:
+                self.elapsed = perf_counter() - start
+            self.done.set()
 
     def stop(self):
-        if self.is_alive():
-            self.cancel.set()
-            self.join(3)
+        # do not wait, a running task ends on its own on a daemon worker
+        self.cancel.set()
 
 
 class SimBrief(object):
@@ -138,10 +231,13 @@ class SimBrief(object):
     source = 'xml'
     uplink_filename = 'b738x'
 
-    def __init__(self, pilot_id: str, path: Path, request_id: str | None) -> None:
+    def __init__(self, pilot_id: str, path: Path, request_id: str | None, validators: dict | None = None) -> None:
         self.pilot_id = pilot_id
         self.path = path
+        self.xml_url = f"https://www.simbrief.com/api/xml.fetcher.php?userid={pilot_id}"
+        self.json_url = f"https://www.simbrief.com/api/xml.fetcher.php?userid={pilot_id}&json=1"
         self.request_id = request_id
+        self.validators = validators  # conditional request headers from the last processed OFP response
         self.ofp = None
         self.origin = None  # Departure ICAO
         self.destination = None  # Destination ICAO
@@ -152,115 +248,154 @@ class SimBrief(object):
         self.fp_info = None
         self.result = False
 
-    @property
-    def xml_url(self) -> str:
-        return f"https://www.simbrief.com/api/xml.fetcher.php?userid={self.pilot_id}"
-
-    @property
-    def json_url(self) -> str:
-        return f"https://www.simbrief.com/api/xml.fetcher.php?userid={self.pilot_id}&json=1"
-
     @staticmethod
-    def run(pilot_id: str, path: Path, request_id=None) -> dict:
+    def run(pilot_id: str, path: Path, request_id=None, validators=None) -> dict:
         """
         return
-        {'error', 'request_id', 'coroute_filename', 'message', 'fp_info'}
+        {'error', 'request_id', 'validators', 'message', 'fp_info'}
         """
 
-        s = SimBrief(pilot_id, path, request_id)
+        s = SimBrief(pilot_id, path, request_id, validators)
         url = s.xml_url if s.source == 'xml' else s.json_url
         response = s.query(url)
-        if not s.error:
-            s.process(response)
+        if not s.error and response:
+            s.process(*response)
         result = {
             'error': s.error,
             'request_id': s.request_id,
+            'validators': s.validators,
             'message': s.message,
             'fp_info': s.fp_info
         }
         return result
 
-    def query(self, url: str) -> str | None:
-        response, error = get_from_url(url)
+    def query(self, url: str) -> tuple[bytes, str | None] | None:
+        # conditional GET: server answers 304 with no body if the OFP did not change
+        response, error = get_from_url(url, headers=self.validators or None, stream=True)
         if error:
+            if isinstance(response, requests.Response):
+                response.close()
             if error == 400:
                 self.message = "Error: is your pilotID correct?"
             else:
                 self.message = "Error trying to connect to SimBrief"
             self.error = error
         elif isinstance(response, requests.Response):
-            return response.text
+            with response:
+                if response.status_code == 304:
+                    self.message = "No new OFP available"
+                    return None
+                self.validators = {
+                    header: response.headers[key]
+                    for header, key in (('If-None-Match', 'ETag'), ('If-Modified-Since', 'Last-Modified'))
+                    if key in response.headers
+                }
+                try:
+                    return self.read_ofp(response)
+                except requests.exceptions.RequestException as e:
+                    print(f"*** SimBrief connection error: {e.args[0]}")
+                    self.message = "Error trying to connect to SimBrief"
+                    self.error = e.args[0]
+
+    def read_ofp(self, response: requests.Response) -> tuple[bytes, str | None] | None:
+        """
+        read the head of the OFP first: request_id is in the params section at the top,
+        if it matches the OFP we already have the rest of the document is never downloaded.
+        return the OFP and its request_id, None if not found in the head
+        """
+        # raw bytes: the XML parser reads the encoding from the declaration,
+        # no need for requests to guess the charset and decode the whole OFP
+        chunks = response.iter_content(chunk_size=8192)
+        content = b''
+        match = None
+        for chunk in chunks:
+            content += chunk
+            match = REQUEST_ID_RE.search(content)
+            if match or len(content) >= REQUEST_ID_PROBE:
+                break
+        request_id = match.group(1).decode() if match else None
+        if request_id is not None and request_id == self.request_id:
+            self.message = "No new OFP available"
+            return None
+        return content + b''.join(chunks), request_id
 
     def download(self, source: str, destination: Path) -> Path | bool:
-        response, error = get_from_url(source)
+        # stream the file on the keep-alive session, writing it in chunks
+        response, error = get_from_url(source, stream=True)
         if error:
+            if isinstance(response, requests.Response):
+                response.close()
             self.message = "Error downloading fms file from SimBrief"
             self.error = error
             return False
         elif isinstance(response, requests.Response):
+            # write next to the destination and swap it in when complete,
+            # a broken download never leaves a truncated fms file behind
+            part = destination.with_name(destination.name + '.part')
             try:
-                with open(destination, 'wb') as f:
-                    f.write(response.content)
+                with response, open(part, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                        f.write(chunk)
+                os.replace(part, destination)
             except Exception as e:
+                part.unlink(missing_ok=True)
                 print(f"*** SimBrief download error: {e.args[0]}")
                 self.message = "Error writing FP file"
                 self.error = e.args[0]
                 return False
         return destination
 
-    def process(self, text: str):
-        """ only XML now"""
-        data = ET.fromstring(text)
-
-        request_id = data.find('params').find('request_id').text
-        if self.request_id == request_id:
-            # no new OFP
-            self.message = "No new OFP available"
-            return
-        ofp = shrink_xml(data)
+    def process(self, content: bytes, request_id: str | None = None):
+        """ only XML now, request_id already checked by read_ofp if given"""
+        ofp = shrink_xml(content)
+        # one pass over the params section
+        params = {el.tag: el.text for el in ofp.find('params')}
+
+        if request_id is None:
+            # request_id was not in the head of the OFP
+            request_id = params.get('request_id')
+            if self.request_id == request_id:
+                # no new OFP
+                self.message = "No new OFP available"
+                return
         fp_filename = self.find_or_retrieve_fp(ofp)
         if fp_filename:
             self.request_id = request_id
             self.coroute_filename = fp_filename
-            parsed = self.parse_ofp(ofp)
+            parsed = self.parse_ofp(ofp, layout=params.get('ofp_layout'))
             if self.create_xml_file(ofp, parsed):
                 self.message = "All set!"
                 # get more info
-                callsign = ofp.find('atc').find('callsign').text
-                weights = ofp.find('weights')
-                u = ofp.find('params').find('units').text
-                oew = weights.find('oew').text
-                cargo = weights.find('cargo').text
-                payload = weights.find('payload').text
-                zfw = weights.find('est_zfw').text
-                tow = weights.find('est_tow').text
-                ldw = weights.find('est_ldw').text
+                callsign = ofp.findtext('atc/callsign')
+                # one pass over the weights section
+                weights = {el.tag: el.text for el in ofp.find('weights')}
+                fmt = weight_formatter(params.get('units'))
                 self.fp_info = {
                     'origin': self.origin.upper().strip(),
                     'destination': self.destination.upper().strip(),
                     'callsign': callsign,
                     'co route': fp_filename,
-                    'oew': f"{oew} {u} ({weight_transform(oew, u)})",
-                    'pax': f"{weights.find('pax_count_actual').text}",
-                    'cargo': f"{cargo} {u} ({weight_transform(cargo, u)})",
-                    'payload': f"{payload} {u} ({weight_transform(payload, u)})",
-                    'zfw': f"{zfw} {u} ({weight_transform(zfw, u)})",
-                    'tow': f"{tow} {u} ({weight_transform(tow, u)})",
-                    'ldw': f"{ldw} {u} ({weight_transform(ldw, u)})"
+                    'oew': fmt(weights['oew']),
+                    'pax': f"{weights['pax_count_actual']}",
+                    'cargo': fmt(weights['cargo']),
+                    'payload': fmt(weights['payload']),
+                    'zfw': fmt(weights['est_zfw']),
+                    'tow': fmt(weights['est_tow']),
+                    'ldw': fmt(weights['est_ldw'])
                 }
 
-    def parse_ofp(self, ofp: ET.Element) -> dict:
+    def parse_ofp(self, ofp: ET.Element, layout: str | None) -> dict:
         """
         LIDO: \n400 288/021 -54  400 320/020 -54  400 332/028 -55  350 330/022 -44\n380 272/019 -50  380 310/016 -50  380 333/024 -51  310 343/025 -34\n360 285/017 -46  360 319/017 -46  360 331/023 -46  200 005/009 -10\n340 301/016 -42  340 326/019 -42  340 328/021 -42  150 297/004 +02\n320 313/019 -36  320 328/021 -37  320 332/024 -37  100 258/001 +11
         """
-        layout = ofp.find('params').find('ofp_layout').text
-        fix = ofp.find('navlog').findall('fix')[-1]
-        if fix.find('ident').text == ofp.find('destination').find('icao_code').text:
-            dest_isa = int(fix.find('oat_isa_dev').text)
+        # last fix, without building the list of the whole navlog
+        fix = next(el for el in reversed(ofp.find('navlog')) if el.tag == 'fix')
+        if fix.findtext('ident') == self.destination:
+            dest_isa = int(fix.findtext('oat_isa_dev'))
         else:
             # use avg isa dev
-            dest_isa = int(ofp.find('general').find('avg_temp_dev').text)
-        dest_metar = ofp.find('destination').find('metar').text
+            dest_isa = int(ofp.findtext('general/avg_temp_dev'))
+        dest_metar = ofp.findtext('destination/metar')
 
         return {
             'dest_isa': dest_isa,
@@ -270,10 +405,8 @@ class SimBrief(object):
 
     def find_or_retrieve_fp(self, ofp: ET.Element) -> str | bool:
 
-        orig = ofp.find('origin')
-        dest = ofp.find('destination')
-        self.origin = orig.find('icao_code').text
-        self.destination = dest.find('icao_code').text
+        self.origin = ofp.findtext('origin/icao_code')
+        self.destination = ofp.findtext('destination/icao_code')
         if not (self.origin and self.destination):
             return False
 
@@ -282,22 +415,23 @@ class SimBrief(object):
         # There could be a fmx file from FMC. it's not usable for UPLINK, just for CO ROUTE
         # look for a CO ROUTE file
         file = None
-        recent = datetime.now() - timedelta(days=DAYS)
-        files = [
-            f for f in self.path.iterdir()
-            if f.suffix in ('.fms', '.fmx')
-            and f.stem.startswith(self.origin)
-            and self.destination in f.stem
-            and datetime.fromtimestamp(f.stat().st_ctime) > recent
-        ]
+        recent = time() - DAYS * 86400
+        # scandir entries cache their stat result, so each file is stat'ed only once
+        with os.scandir(self.path) as entries:
+            files = [
+                f for f in entries
+                if f.name.endswith(('.fms', '.fmx'))
+                and f.name.startswith(self.origin)
+                and self.destination in f.name
+                and f.stat().st_ctime > recent
+            ]
         if files:
             # user already has a FP for this OFP
-            file = max(files, key=lambda x: x.stat().st_ctime)
+            file = Path(max(files, key=lambda x: x.stat().st_ctime))
         else:
             # need to download the fms file from SimBrief
             file = Path(self.path, self.origin + self.destination + '.fms')
-            fms_downloads = ofp.find('fms_downloads')
-            self.fp_link = fms_downloads.find('directory').text + fms_downloads.find('xpe').find('link').text
+            self.fp_link = ofp.findtext('fms_downloads/directory') + ofp.findtext('fms_downloads/xpe/link')
             result = self.download(self.fp_link, file)
             if not result:
                 return False
@@ -310,57 +444,58 @@ class SimBrief(object):
     def create_xml_file(self, ofp: ET.Element, data: dict, filename: str = uplink_filename) -> bool:
         """we need to recreate the plan_html parts we use as in LIDO format"""
 
-        # const
-        summary_tag = '''<div style="line-height:14px;font-size:13px"><pre><!--BKMK///OFP///0--><!--BKMK///Summary and Fuel///1--><b>[ OFP ]\n--------------------------------------------------------------------</b>\nOFP 1\n\n'''
-        wind_tag = '''<h2 style="page-break-after: always;"> </h2><!--BKMK///Wind Information///1-->--------------------------------------------------------------------\n WIND INFORMATION \nDESCENT\n'''
-        wx_tag = '''<h2 style="page-break-after: always;"> </h2><!--BKMK///Airport WX List///0--><b>[ Airport WX List ]\n--------------------------------------------------------------------</b>\nDestination:\n'''
-
         dest_isa = f"AVG ISA       {'M' if data['dest_isa'] < 0 else 'P'}{abs(data['dest_isa']):03d}\n\n"
-        winds = '\n'.join([' '.join([e for e in el]) for el in data['winds']]) + '\n\n'
+        winds = '\n'.join(' '.join(el) for el in data['winds'])
         parts = data['dest_metar'].split()[1:]
         parts[0] = parts[0].replace('Z', ' ')
         dest_metar = f"{self.destination}\nSA  {' '.join(parts)}\n"
 
-        plan_html = ofp.find('text').find('plan_html')
+        plan_html = ofp.find('text/plan_html')
 
-        plan_html.text = summary_tag + dest_isa + wind_tag + winds + wx_tag + dest_metar
+        plan_html.text = ''.join((SUMMARY_TAG, dest_isa, WIND_TAG, winds, '\n\n', WX_TAG, dest_metar))
 
         filename = filename + '.xml'
         file = Path(self.path, filename)
-        tree = ET.ElementTree(ofp)
+        tmp = file.with_name(filename + '.tmp')
         try:
-            tree.write(file, encoding='utf-8', xml_declaration=True)
+            # serialize in memory, write the whole document in one call and swap it in,
+            # the FMC never reads a half written uplink file
+            with open(tmp, 'wb') as f:
+                f.write(ET.tostring(ofp, encoding='utf-8', xml_declaration=True))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, file)
             return True
         except Exception as e:
+            tmp.unlink(missing_ok=True)
             self.message = f"Error writing {filename}"
             self.error = e
             return False
 
-    def delete_old_xml_files(self):
-        for f in self.path.iterdir():
-            if f.stem == self.uplink_filename:
-                f.unlink()
-
 
 class Atis(object):
 
+    cache = {}  # icao: (perf_counter, result) of recent requests
+
     def __init__(self, icao: str) -> None:
         self.icao = icao
+        self.url = f"https://atis.report/a/{icao}"
         self.error = None
         self.atis_info = None
         self.result = False
 
-    @property
-    def url(self) -> str:
-        return f"https://atis.report/a/{self.icao}"
-
     @staticmethod
     def run(icao: str) -> dict:
         """
         return
-        {'error', 'request_id', 'coroute_filename', 'message', 'fp_info'}
+        {'error', 'atis'}
         """
 
+        hit = Atis.cache.get(icao)
+        if hit and perf_counter() - hit[0] < (ATIS_ERROR_TTL if hit[1]['error'] else ATIS_TTL):
+            # recent answer for the same airport
+            return hit[1]
+
         a = Atis(icao)
         response = a.query()
         if not a.error:
@@ -369,6 +504,7 @@ class Atis(object):
             'error': a.error,
             'atis': a.atis_info
         }
+        Atis.cache[icao] = (perf_counter(), result)
         return result
 
     def query(self) -> str | None:
@@ -393,31 +529,28 @@ class Atis(object):
         self.atis_info = atis
 
 
-def shrink_xml(data: ET.Element) -> ET.Element:
-    tag_list = [
-        'fetch', 'aircraft', 'times', 'impacts', 'crew', 'notams', 'weather', 'sigmets', 'tracks', 
-        'database_updates', 'files', 'images', 'links', 'prefile', 
-        'vatsim_prefile', 'ivao_prefile', 'pilotedge_prefile', 'poscon_prefile', 'map_data'
-    ]
-
-    for tag in tag_list:
-        results = data.findall(tag)
-        if results:
-            # print(f"found {tag}")
-            for el in results:
-                data.remove(el)
-    for tag in ('origin', 'destination', 'alternate'):
-        el = data.find(tag)
-        if el:
-            taf = el.find('taf')
-            if taf:
-                el.remove(taf)
-            for notam in el.findall('notam'):
-                el.remove(notam)
-            for taf in el.findall('taf'):
-                el.remove(taf)
-
-    return data
+def shrink_xml(content: bytes) -> ET.Element:
+    """
+    parse the OFP dropping the sections we don't use while they stream in,
+    so the tree never holds the whole document
+    """
+    root = None
+    path = []  # open elements, root first
+    for event, el in ET.iterparse(BytesIO(content), events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = el
+            path.append(el)
+            continue
+        path.pop()
+        if len(path) > 1 and path[1].tag in OFP_DROP_TAGS:
+            # inside a section we drop, free it as soon as it is parsed
+            el.clear()
+        elif len(path) == 1 and el.tag in OFP_DROP_TAGS:
+            root.remove(el)
+        elif len(path) == 2 and path[1].tag in AIRPORT_TAGS and el.tag in AIRPORT_DROP_TAGS:
+            path[1].remove(el)
+    return root
 
 
 def extract_dep_arr(ofp: ET.Element) -> tuple[list, list]:
@@ -425,53 +558,58 @@ def extract_dep_arr(ofp: ET.Element) -> tuple[list, list]:
         to mimic Navigraph fms file """
     orig = ofp.find('origin')
     dest = ofp.find('destination')
-    dep_icao = orig.find('icao_code').text
-    arr_icao = dest.find('icao_code').text
-    rte = ofp.find('api_params').find('route').text.split()
+    dep_icao = orig.findtext('icao_code')
+    arr_icao = dest.findtext('icao_code')
+    rte = ofp.findtext('api_params/route', '').split()
     dep = []
     arr = []
 
     if rte:
+        # first and last route elements still to be read, consumed from both ends
+        head, tail = 0, len(rte) - 1
         # Departure
         dep_rwy = orig.find('plan_rwy').text
         if dep_rwy:
             # we have a dep. rwy
             dep.append(f"DEPRWY RW{dep_rwy}")
-        if rte[0].startswith(dep_icao):
-            rte.pop(0)
-        if len(rte) > 1:
-            if '.' in rte[0]:
+        if rte[head].startswith(dep_icao):
+            head += 1
+        if tail - head > 0:
+            first = rte[head]
+            if '.' in first:
                 # we should have SID.TRANS
-                sid, trans = rte[0].split('.')
+                sid, trans = first.split('.')
                 dep.extend([
                     f"SID {sid}",
                     f"SIDTRANS {trans}"
                 ])
-            elif len([c for c in rte[0] if c.isdigit()]) == 1:
+            elif len([c for c in first if c.isdigit()]) == 1:
                 # we should have SID
-                dep.append(f"SID {rte[0]}")
-                if not any(s.isdigit() for s in rte[1]):
-                    dep.append(f"SIDTRANS {rte[1]}")
+                dep.append(f"SID {first}")
+                if not any(s.isdigit() for s in rte[head + 1]):
+                    dep.append(f"SIDTRANS {rte[head + 1]}")
         # Arrival
         arr_rwy = dest.find('plan_rwy').text
         if arr_rwy:
             arr.append(f"DESRWY RW{arr_rwy}")
         des = None
-        if rte[-1].startswith(arr_icao):
-            des = rte.pop[-1]
-        if len(rte) > 3 and rte[0] != rte[-1]:
-            if '.' in rte[-1]:
+        if head <= tail and rte[tail].startswith(arr_icao):
+            des = rte[tail]
+            tail -= 1
+        if tail - head > 2 and rte[head] != rte[tail]:
+            last = rte[tail]
+            if '.' in last:
                 # we should have STAR.TRANS
-                star, trans = rte[-1].split('.')
+                star, trans = last.split('.')
                 arr.extend([
                     f"STAR {star}",
                     f"STARTRANS {trans}"
                 ])
-            elif (len([c for c in rte[-1] if c.isdigit()]) == 1 or rte[-1].endswith(arr_rwy)):
+            elif len([c for c in last if c.isdigit()]) == 1 or (arr_rwy and last.endswith(arr_rwy)):
                 # we should have STAR
-                arr.append(f"STAR {rte[-1]}")
-                if not any(s.isdigit() for s in rte[-2]):
-                    arr.append(f"STARTRANS {rte[-2]}")
+                arr.append(f"STAR {last}")
+                if not any(s.isdigit() for s in rte[tail - 1]):
+                    arr.append(f"STARTRANS {rte[tail - 1]}")
         if des and '/' in des:
             _, app = des.split('/')
             arr.append(f"APP {app}")
@@ -480,93 +618,131 @@ def extract_dep_arr(ofp: ET.Element) -> tuple[list, list]:
 
 def insert_dep_arr(file: Path, dep: list, arr: list) -> None:
     if dep or arr:
-        # insert Navigraph format details in fms file
-        with open(file, mode='r+', encoding='utf-8') as f:
-            content = f.readlines()
-            if dep:
-                idx = content.index(next(l for l in content if l.startswith('ADEP')))
-                for line in dep:
-                    idx += 1
-                    content.insert(idx, line + '\n')
-            if arr:
-                idx = content.index(next(l for l in content if l.startswith('ADES')))
-                for line in arr:
-                    idx += 1
-                    content.insert(idx, line + '\n')
-            f.seek(0)
-            f.writelines(content)
+        # insert Navigraph format details in fms file,
+        # copying it line by line to a temp file swapped in when complete
+        extra = {'ADEP': dep, 'ADES': arr}
+        tmp = file.with_name(file.name + '.tmp')
+        try:
+            with open(file, encoding='utf-8') as src, open(tmp, 'w', encoding='utf-8') as dst:
+                for line in src:
+                    dst.write(line)
+                    lines = extra.get(line[:4])
+                    if lines:
+                        dst.writelines(l + '\n' for l in lines)
+            os.replace(tmp, file)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+
+def find_section(source: str, start: str, end: str) -> str:
+    """
+    Return the text between the first start marker and the following end marker,
+    slicing the (large) source only once instead of splitting it all
+    """
+    i = source.index(start) + len(start)
+    j = source.find(end, i)
+    return source[i:j] if j >= 0 else source[i:]
+
+
+def lido_descent_winds(source: str) -> list:
+    """LIDO and similar layouts: last FL WIND TEMP group of each DESCENT line"""
+    text = find_section(source, 'DESCENT', '\n\n')
+    lines = text.split('\n')[1:]
+    return [m.groups() for m in map(DESCENT_WIND_RE.search, lines) if m]
+
+
+def ual_descent_winds(source: str) -> list:
+    """UAL 2018 layout: html table rows"""
+    text = find_section(source, 'DESCENT WINDS', 'STARTFWZPAD')
+    lines = text.split('</tr><tr>')[1:5]
+    # one parser run for all the rows
+    table = ET.XML(f"<table><tr>{'</tr><tr>'.join(lines)}</tr></table>")
+    return [tuple(cell.text.strip().replace('FL', '') or '+15' for cell in row) for row in table]
+
+
+def dal_descent_winds(source: str) -> list:
+    """DAL layout: column based table, down to FL100"""
+    text = find_section(source, 'DESCENT FORECAST WINDS', '*')
+    lines = text.split('\n')[1:-1]
+    # table is column based, walk columns once and stop at FL100
+    winds = []
+    for alt, wind, *_ in zip(*[line.split() for line in lines]):
+        winds.append((alt[:-2], f"{wind[:2]}0/{wind[-3:]}", '+15'))
+        if alt == "10000":
+            break
+    return winds
+
+
+def swa_descent_winds(source: str) -> list:
+    """SWA layout: column based table"""
+    text = find_section(source, 'DESCENT WINDS', '\n\n')
+    lines = text.strip().split('\n')
+    return [
+        (
+            el[0][:-2],
+            f"{el[1][:2]}0{el[1][2:6]}", 
+            f"{'+' if 'P' in el[1] else '-'}{el[1][-2:]}"
+        )
+        for el in zip(*[line.split() for line in lines])
+    ]
+
+
+def klm_descent_winds(source: str) -> list:
+    """KLM layout: CRZ ALT block"""
+    text = find_section(source, 'CRZ ALT', 'DEFRTE')
+    lines = text.replace('FL', '').split('\n')[:3]
+    return [(*l.split()[-2:], '+15') for l in lines]
+
+
+# OFP layout -> descent winds parser
+DESCENT_WIND_PARSERS = {
+    'UAL 2018': ual_descent_winds,
+    'DAL': dal_descent_winds,
+    'SWA': swa_descent_winds,
+    'KLM': klm_descent_winds,
+}
+LIDO_LAYOUTS = ('RYR', 'LIDO', 'THY', 'ACA')  # layout names containing one of these use LIDO format
 
 
 def extract_descent_winds(ofp: ET.Element, layout: str) -> list:
     """
     Descent wind have to be extracted from plan_html section, so it's dependant on OFP layout
     """
-    source = ofp.find('text').find('plan_html').text
-
-    if any(s in layout for s in ('RYR', 'LIDO', 'THY', 'ACA')):
-        text = source.split('DESCENT')[1].split('\n\n')[0]
-        lines = text.split('\n')[1:]
-        return [tuple(l.split()[-3:]) for l in lines]
-    elif layout == 'UAL 2018':
-        text = source.split('DESCENT WINDS')[1].split('STARTFWZPAD')[0]
-        lines = text.split('</tr><tr>')[1:5]
-        winds = []
-        for l in lines:
-            table = ET.XML(f"<html> + {l} + </html>")
-            rows = iter(table)
-            winds.append(tuple(row.text.strip().replace('FL', '') or '+15' for row in rows))
-    elif layout == 'DAL':
-        text = source.split('DESCENT FORECAST WINDS')[1].split('*')[0]
-        lines = text.split('\n')[1:-1]
-        data = list(zip(*[line.split() for line in lines]))
-        idx100 = list(map(lambda x:x[0], data)).index("10000") + 1
-        return [(el[0][:-2], f"{el[1][:2]}0/{el[1][-3:]}", '+15') for el in data][:idx100]
-    elif layout == 'SWA':
-        text = source.split('DESCENT WINDS')[1].split('\n\n')[0]
-        lines = text.strip().split('\n')
-        data = list(zip(*[line.split() for line in lines]))
-        return [
-            (
-                el[0][:-2],
-                f"{el[1][:2]}0{el[1][2:6]}", 
-                f"{'+' if 'P' in el[1] else '-'}{el[1][-2:]}"
-            )
-            for el in data
-        ]
-    elif layout == 'KLM':
-        text = source.split('CRZ ALT')[1].split('DEFRTE')[0]
-        lines = lines = text.replace('FL', '').split('\n')[:3]
-        return [(*l.split()[-2:], '+15') for l in lines]
-    else:
+    parser = DESCENT_WIND_PARSERS.get(layout)
+    if not parser and any(s in layout for s in LIDO_LAYOUTS):
+        parser = lido_descent_winds
+    if not parser:
         # AAL, QFA have no descent winds in OFP
         # AFR, DLH, UAE, JZA, JBU, GWI, EZY, ETD, EIN, BER, BAW, AWE have no 738 or are not operative
         return [('', '', '')]*5
-    return winds
+    return parser(ofp.findtext('text/plan_html'))
+
+
+@lru_cache(maxsize=512)
+def measure(text: str) -> float:
+    """width of text in the widget font, button labels and D-ATIS words repeat a lot"""
+    return xp.measureString(FONT, text)
 
 
 def str2int(string: str) -> int:
     v = string.strip()
-    if len(v) == 0:
+    if not v:
         return 0
-    sign = 1
-    if not v.isdigit():
-        if v[1:].isdigit() and v[0] in ('-', '+'):
-            if v[0] == '-':
-                sign = -1
-            v = v[1:]
-        else:
-            raise ValueError(f"Input string {v} is not a valid integer.")
-    return int(v) * sign
+    try:
+        # int() handles the sign on its own
+        return int(v)
+    except ValueError:
+        raise ValueError(f"Input string {v} is not a valid integer.") from None
+
+
+def weight_formatter(unit: str):
+    """return a function formatting an OFP weight followed by its conversion to the other unit"""
+    m, t = WEIGHT_FACTORS.get(unit, WEIGHT_FACTORS['lbs'])
 
+    def fmt(weight: str) -> str:
+        return f"{weight} {unit} ({round(str2int(weight) * m)} {t})"
 
-def weight_transform(weight: str, unit: str) -> str:
-    if unit == 'kgs':
-        t = 'lbs'
-        m = 2.205
-    else:
-        t = 'kgs'
-        m = 0.4535
-    return f"{round(str2int(weight) * m)} {t}"
+    return fmt
 
 
 class EasyCommand:
@@ -608,6 +784,12 @@ class FloatingWidget(object):
     MARGIN = 10
     HEADER = 16
 
+    # user info line offsets from the subwindow left margin
+    PILOT_CAPTION_RIGHT = 90
+    PILOT_INPUT_LEFT = 88
+    PILOT_INPUT_RIGHT = 145
+    PILOT_BUTTON_LEFT = 148
+
     left, top, right, bottom = 0, 0, 0, 0
 
     def __init__(self, title: str, x: int, y: int, width: int = WIDTH, height: int = HEIGHT) -> None:
@@ -621,11 +803,15 @@ class FloatingWidget(object):
         )
         self.pilot_info_subwindow = None
         self.info_line = None
+        self.descriptors = {}  # widget: text we set, read back without querying X-Plane
+        self.visible = {}  # widget: visibility we set
+        self.setup_state = False  # pilot_id last shown by setup_widget, None in edit mode
         self.content_widget = {
             'subwindow': None,
             'title': None,
             'lines': []
         }
+        self.content_lines = None  # lines currently displayed in content widget
 
         # main widget
         self.widget = xp.createWidget(
@@ -657,12 +843,26 @@ class FloatingWidget(object):
     def cr() -> int:
         return FloatingWidget.LINE + FloatingWidget.MARGIN
 
-    @staticmethod
-    def check_widget_descriptor(widget, text: str) -> None:
-        if text not in xp.getWidgetDescriptor(widget):
+    def set_descriptor(self, widget, text: str) -> None:
+        # only cross into X-Plane when the text actually changes
+        if self.descriptors.get(widget) != text:
+            self.descriptors[widget] = text
             xp.setWidgetDescriptor(widget, text)
+
+    def show(self, widget) -> None:
+        if self.visible.get(widget) is not True:
+            self.visible[widget] = True
             xp.showWidget(widget)
 
+    def hide(self, widget) -> None:
+        if self.visible.get(widget) is not False:
+            self.visible[widget] = False
+            xp.hideWidget(widget)
+
+    def check_widget_descriptor(self, widget, text: str) -> None:
+        self.set_descriptor(widget, text)
+        self.show(widget)
+
     @classmethod
     def create_window(cls, title: str, x: int, y: int, width: int = WIDTH, height: int = HEIGHT) -> FloatingWidget:
         return cls(title, x, y, width, height)
@@ -687,19 +887,20 @@ class FloatingWidget(object):
             self.top -= self.cr()
 
     def check_info_line(self, message: str) -> None:
-        if xp.getWidgetDescriptor(self.info_line) != message:
-            xp.setWidgetDescriptor(self.info_line, message)
+        self.set_descriptor(self.info_line, message)
 
     def add_button(self, text: str, subwindow: bool = False, align: str = 'left'):
-        width = int(xp.measureString(FONT, text)) + FONT_WIDTH*4
+        width = int(measure(text)) + FONT_WIDTH*4
         if align == 'left':
             l, r = self.left + subwindow*self.MARGIN, self.left + width + subwindow*self.MARGIN
         else:
             l, r = self.right - width - subwindow*self.MARGIN, self.right - subwindow*self.MARGIN
-        return xp.createWidget(
+        button = xp.createWidget(
             l, self.top, r, self.top - self.LINE,
             0, text, 0, self.widget, xp.WidgetClass_Button
         )
+        self.descriptors[button] = text
+        return button
 
     def add_subwindow(self, lines: int | None = None):
         height = self.get_height(lines)
@@ -714,24 +915,24 @@ class FloatingWidget(object):
         l, t, r, b = self.get_subwindow_margins(lines=1)
         # user info widgets
         caption = xp.createWidget(
-            l, t, l + 90, b,
+            l, t, l + self.PILOT_CAPTION_RIGHT, b,
             1, 'Simbrief PilotID:', 0, self.widget, xp.WidgetClass_Caption
         )
         self.pilot_id_input = xp.createWidget(
-            l + 88, t, l + 145, b,
+            l + self.PILOT_INPUT_LEFT, t, l + self.PILOT_INPUT_RIGHT, b,
             1, "", 0, self.widget, xp.WidgetClass_TextField
         )
         xp.setWidgetProperty(self.pilot_id_input, xp.Property_MaxCharacters, 10)
         self.pilot_id_caption = xp.createWidget(
-            l + 88, t, l + 145, b,
+            l + self.PILOT_INPUT_LEFT, t, l + self.PILOT_INPUT_RIGHT, b,
             1, "", 0, self.widget, xp.WidgetClass_Caption
         )
         self.save_button = xp.createWidget(
-            l + 148, t, r, b,
+            l + self.PILOT_BUTTON_LEFT, t, r, b,
             1, "SAVE", 0, self.widget, xp.WidgetClass_Button
         )
         self.edit_button = xp.createWidget(
-            l + 148, t, r, b,
+            l + self.PILOT_BUTTON_LEFT, t, r, b,
             1, "CHANGE", 0, self.widget, xp.WidgetClass_Button
         )
         self.top = b - self.MARGIN*2
@@ -747,47 +948,52 @@ class FloatingWidget(object):
             )
             t -= self.cr()
         # add content lines
-        while t > b:
-            self.content_widget['lines'].append(
-                xp.createWidget(l, t, r, t - self.LINE,
-                                1, '--', 0, self.widget, xp.WidgetClass_Caption)
-            )
-            t -= self.LINE
+        lines = self.content_widget['lines']
+        for top in range(t, b, -self.LINE):
+            line = xp.createWidget(l, top, r, top - self.LINE,
+                                   1, '--', 0, self.widget, xp.WidgetClass_Caption)
+            self.descriptors[line] = '--'
+            lines.append(line)
 
     def show_content_widget(self):
-        if not xp.isWidgetVisible(self.content_widget['subwindow']):
-            xp.showWidget(self.content_widget['subwindow'])
+        if self.visible.get(self.content_widget['subwindow']) is not True:
+            self.show(self.content_widget['subwindow'])
             if self.content_widget['title']:
-                xp.showWidget(self.content_widget['title'])
+                self.show(self.content_widget['title'])
             for el in self.content_widget['lines']:
-                xp.showWidget(el)
+                self.show(el)
 
     def hide_content_widget(self):
-        if xp.isWidgetVisible(self.content_widget['subwindow']):
-            xp.hideWidget(self.content_widget['subwindow'])
+        if self.visible.get(self.content_widget['subwindow']) is not False:
+            self.hide(self.content_widget['subwindow'])
             if self.content_widget['title']:
-                xp.hideWidget(self.content_widget['title'])
+                self.hide(self.content_widget['title'])
             for el in self.content_widget['lines']:
-                xp.hideWidget(el)
+                self.hide(el)
 
     def check_content_widget(self, lines: list[tuple[str, str] or str]):
+        if lines == self.content_lines:
+            # nothing changed since last check
+            return
+        self.content_lines = list(lines)
         content = self.content_widget['lines']
         for i, el in enumerate(lines):
             if i < len(content):
                 text = str(el) if not isinstance(el, tuple) else  f"{el[0].upper()}: {el[1]}"
-                if not text in xp.getWidgetDescriptor(content[i]):
-                    xp.setWidgetDescriptor(content[i], text)
+                self.set_descriptor(content[i], text)
 
     def populate_content_widget(self, lines: list[tuple[str, str] or str]):
+        self.content_lines = list(lines)
         content = self.content_widget['lines']
         for i, el in enumerate(lines):
             text = str(el) if not isinstance(el, tuple) else  f"{el[0].upper()}: {el[1]}"
-            xp.setWidgetDescriptor(content[i], text)
+            self.set_descriptor(content[i], text)
 
     def clear_content_widget(self):
+        self.content_lines = None
         content = self.content_widget['lines']
         for el in content:
-            xp.setWidgetDescriptor(el, "--")
+            self.set_descriptor(el, "--")
 
     def switch_window_position(self):
         if xp.windowIsPoppedOut(self.window):
@@ -811,17 +1017,21 @@ class FloatingWidget(object):
             xp.setWindowIsVisible(self.window, 0)
 
     def setup_widget(self, pilot_id: str | None = None):
+        if pilot_id == self.setup_state:
+            # widgets already set up for this pilot_id
+            return
+        self.setup_state = pilot_id
         if pilot_id:
-            xp.hideWidget(self.pilot_id_input)
-            xp.hideWidget(self.save_button)
-            xp.setWidgetDescriptor(self.pilot_id_caption, f"{pilot_id}")
-            xp.showWidget(self.pilot_id_caption)
-            xp.showWidget(self.edit_button)
+            self.hide(self.pilot_id_input)
+            self.hide(self.save_button)
+            self.set_descriptor(self.pilot_id_caption, f"{pilot_id}")
+            self.show(self.pilot_id_caption)
+            self.show(self.edit_button)
         else:
-            xp.hideWidget(self.pilot_id_caption)
-            xp.hideWidget(self.edit_button)
-            xp.showWidget(self.pilot_id_input)
-            xp.showWidget(self.save_button)
+            self.hide(self.pilot_id_caption)
+            self.hide(self.edit_button)
+            self.show(self.pilot_id_input)
+            self.show(self.save_button)
             xp.setKeyboardFocus(self.pilot_id_input)
 
     def destroy(self) -> None:
@@ -846,6 +1056,8 @@ class PythonInterface(object):
         # Dref init
         self.gears_on_ground = xp.findDataRef('sim/flightmodel2/gear/on_ground')
         self.engines_burning_fuel = xp.findDataRef('sim/flightmodel2/engines/engine_is_burning_fuel')
+        self.gears_values = []  # reused getDatavi buffers
+        self.engines_values = []
 
         # app init
         self.config_file = Path(self.prefs, 'simbrief2zibo.prf')
@@ -853,13 +1065,18 @@ class PythonInterface(object):
         self.async_task = False
         self.async_datis = False
         self.request_id = None  # OFP generated ID
+        self.ofp_validators = None  # ETag / Last-Modified of the SimBrief response for the current OFP
+        self.ofp_pilot_id = None  # pilot ID request_id and validators belong to
+        self.ofp_backoff = DEFAULT_SCHEDULE  # seconds to next SimBrief query while no new OFP is found
         self.fp_info = {}  # information to display in the settings window
+        self.fp_info_lines = []  # fp_info content lines, formatted once per OFP
         self.aircraft = False
         self.acf_path = None
 
         # D-ATIS init
         self.datis_request = False  # D-ATIS request ICAO
         self.datis_content = []
+        self.datis_lines = {}  # D-ATIS text: wrapped lines, oldest first
 
         # status flags
         self.flight_started = False  # tracks simulation phase
@@ -873,6 +1090,8 @@ class PythonInterface(object):
         self.datis = None
         self.details_message = ""  # text displayed in widget info_line
         self.datis_message = ""  # information to display in the D-ATIS window
+        self.details_dirty = True  # widgets need to be synced with plugin state
+        self.datis_dirty = True
 
         # create main menu and widget
         self.main_menu = self.create_main_menu()
@@ -896,21 +1115,21 @@ class PythonInterface(object):
 
     @property
     def aircraft_detected(self) -> bool:
-        self.check_aircraft()
+        # kept up to date by check_aircraft on plugin enable and on user plane loaded message
         return bool(self.aircraft)
 
     @property
     def engines_started(self) -> bool:
-        values = []
-        xp.getDatavi(self.engines_burning_fuel, values, count=2)
-        return any(values)
+        self.engines_values.clear()
+        xp.getDatavi(self.engines_burning_fuel, self.engines_values, count=2)
+        return any(self.engines_values)
 
     @property
     def on_ground(self) -> bool:
-        values = []
-        xp.getDatavi(self.gears_on_ground, values, count=3)
+        self.gears_values.clear()
+        xp.getDatavi(self.gears_on_ground, self.gears_values, count=3)
         # should be all(values) but after Zibo loading front gear appears to be in the air
-        return any(values)
+        return any(self.gears_values)
 
     @property
     def at_gate(self) -> bool:
@@ -920,11 +1139,8 @@ class PythonInterface(object):
         _, acf_path = xp.getNthAircraftModel(0)
         if acf_path != self.acf_path:
             self.acf_path = acf_path
-            acf = next((p[0] for p in AIRCRAFTS if p[1] in self.acf_path), None)
-            if acf:
-                self.aircraft = acf
-            else:
-                self.aircraft = False
+            match = ACF_RE.search(acf_path)
+            self.aircraft = ACF_NAMES[match.group()] if match else False
 
     def check_datis_request(self):
         if self.async_datis:
@@ -937,8 +1153,8 @@ class PythonInterface(object):
                     self.datis_message = "An unknown error occurred"
                     xp.log(f" *** Unmanaged error in async task {self.async_datis.pid}: {self.async_datis.result}")
                 else:
-                    # result: {error, atis_info}
-                    error, result = self.async_datis.result.values()
+                    # result: {error, atis}
+                    error, result = self.async_datis.result['error'], self.async_datis.result['atis']
                     if error:
                         # a managed error occurred
                         self.datis_message = "Error retrieving D-ATIS"
@@ -954,6 +1170,7 @@ class PythonInterface(object):
                 # reset download
                 self.async_datis = False
                 self.datis_request = False
+                self.datis_dirty = True
             else:
                 # no answer yet, waiting ...
                 pass
@@ -967,6 +1184,7 @@ class PythonInterface(object):
                 self.datis_request,
             )
             self.async_datis.start()
+            self.datis_dirty = True
 
     def create_main_menu(self):
         # create Menu
@@ -1010,6 +1228,7 @@ class PythonInterface(object):
         self.details.add_content_widget(title='OFP info:')
 
         self.details.setup_widget(self.pilot_id)
+        self.details_dirty = True
 
         # Register our widget handler
         self.settingsWidgetHandlerCB = self.detailsWidgetHandler
@@ -1026,6 +1245,8 @@ class PythonInterface(object):
         self.datis.top = t
         self.datis.dep_button = self.datis.add_button("ORIG", subwindow=True)
         self.datis.arr_button = self.datis.add_button("DEST", subwindow=True, align='right')
+        # fp_info key of the airport each button requests
+        self.datis.airport_buttons = {self.datis.dep_button: 'origin', self.datis.arr_button: 'destination'}
         self.datis.top = b - self.datis.MARGIN
 
         # info message line
@@ -1033,27 +1254,38 @@ class PythonInterface(object):
 
         # add content widget
         self.datis.add_content_widget()
+        self.datis_dirty = True
 
         # Register our widget handler
         self.atisWidgetHandlerCB = self.datisWidgetHandler
         xp.addWidgetCallback(self.datis.widget, self.atisWidgetHandlerCB)
 
-    def detailsWidgetHandler(self, inMessage, inWidget, inParam1, inParam2):
-        if not self.details:
-            return 1
-
+    def refresh_details(self) -> None:
         self.details.check_info_line(self.details_message)
 
         if self.aircraft_detected and self.fp_checked and self.fp_info:
-            self.details.check_content_widget(lines=list(self.fp_info.items())[2:])
+            self.details.check_content_widget(lines=self.fp_info_lines)
             self.details.show_content_widget()
         else:
             self.details.hide_content_widget()
 
         if self.fp_checked and not self.flight_started:
-            xp.showWidget(self.details.reload_button)
+            self.details.show(self.details.reload_button)
         else:
-            xp.hideWidget(self.details.reload_button)
+            self.details.hide(self.details.reload_button)
+
+    def detailsWidgetHandler(self, inMessage, inWidget, inParam1, inParam2):
+        if not self.details:
+            return 1
+
+        if not self.details_dirty and inMessage not in (xp.Msg_PushButtonPressed, xp.Message_CloseButtonPushed):
+            # nothing to sync nor to handle
+            return 0
+
+        if self.details_dirty:
+            # plugin state changed since last sync
+            self.details_dirty = False
+            self.refresh_details()
 
         if inMessage == xp.Message_CloseButtonPushed:
             if self.details.window:
@@ -1065,22 +1297,22 @@ class PythonInterface(object):
                 self.details.switch_window_position()
             if inParam1 == self.details.save_button:
                 self.save_settings()
+                self.details_dirty = True
                 return 1
             if inParam1 == self.details.edit_button:
                 xp.setWidgetDescriptor(self.details.pilot_id_input, f"{self.pilot_id}")
                 self.pilot_id = None
                 self.details.setup_widget()
+                self.details_dirty = True
                 return 1
             if inParam1 == self.details.reload_button:
                 self.fp_checked = False
                 self.details_message = 'OFP reload requested'
+                self.details_dirty = True
                 return 1
         return 0
 
-    def datisWidgetHandler(self, inMessage, inWidget, inParam1, inParam2):
-        if not self.datis:
-            return 0
-
+    def refresh_datis(self) -> None:
         self.datis.check_info_line(self.datis_message)
 
         if self.aircraft_detected and self.fp_info:
@@ -1091,14 +1323,28 @@ class PythonInterface(object):
                 self.datis.show_content_widget()
             else:
                 self.datis.hide_content_widget()
-
-            if self.datis_request:
-                # we have an D-ATIS request
-                self.check_datis_request()
         else:
             self.datis.hide_content_widget()
-            xp.hideWidget(self.datis.dep_button)
-            xp.hideWidget(self.datis.arr_button)
+            self.datis.hide(self.datis.dep_button)
+            self.datis.hide(self.datis.arr_button)
+
+    def datisWidgetHandler(self, inMessage, inWidget, inParam1, inParam2):
+        if not self.datis:
+            return 0
+
+        if not (self.datis_dirty or self.datis_request) \
+                and inMessage not in (xp.Msg_PushButtonPressed, xp.Message_CloseButtonPushed):
+            # nothing to sync, poll nor handle
+            return 0
+
+        if self.datis_request and self.aircraft_detected and self.fp_info:
+            # we have an D-ATIS request
+            self.check_datis_request()
+
+        if self.datis_dirty:
+            # plugin or D-ATIS state changed since last sync
+            self.datis_dirty = False
+            self.refresh_datis()
 
         # manage close window button
         if inMessage == xp.Message_CloseButtonPushed:
@@ -1110,10 +1356,12 @@ class PythonInterface(object):
         if inMessage == xp.Msg_PushButtonPressed:
             if inParam1 == self.datis.popout_button:
                 self.datis.switch_window_position()
-            else:
-                icao = self.fp_info['origin' if inParam1 == self.datis.dep_button else 'destination']
-                xp.log(f"ATIS request: {icao}")
+            elif inParam1 in self.datis.airport_buttons:
+                icao = self.fp_info[self.datis.airport_buttons[inParam1]]
+                if DEBUG:
+                    xp.log(f"ATIS request: {icao}")
                 self.datis_request = icao
+                self.datis_dirty = True
             return 1
 
         return 0
@@ -1134,26 +1382,46 @@ class PythonInterface(object):
         if self.aircraft_detected and self.fp_checked:
             self.details_message = 'OFP reload requested'
             self.fp_checked = False
+            self.details_dirty = True
 
     def format_atis_info(self, string: str) -> list:
-        # create lines from D-ATIS string
-        width = self.datis.content_width
-        words = string.split(' ')
-        result = ['']
-        for word in words:
-            if xp.measureString(FONT, result[-1] + ' ' + word) < width:
-                result[-1] += word if not result[-1] else ' ' + word
+        # same D-ATIS text as a recent request, lines are already there (content width is fixed)
+        lines = self.datis_lines.get(string)
+        if lines is None:
+            lines = self.wrap_atis_info(string, self.datis.content_width)
+            if len(self.datis_lines) >= ATIS_CACHE:
+                # drop the oldest one
+                del self.datis_lines[next(iter(self.datis_lines))]
+            self.datis_lines[string] = lines
+        return lines
+
+    @staticmethod
+    def wrap_atis_info(string: str, width: int) -> list:
+        # create lines from D-ATIS string, measuring each word only once
+        space = measure(' ')
+        result = []
+        line = ''
+        line_width = 0
+        for word in string.split(' '):
+            word_width = measure(word)
+            if line_width + space + word_width >= width:
+                result.append(line)
+                line, line_width = word, word_width
+            elif line:
+                line += ' ' + word
+                line_width += space + word_width
             else:
-                result.append(word)
+                line, line_width = word, word_width
+        result.append(line)
         return result
 
     def loopCallback(self, lastCall, elapsedTime, counter, refCon):
         """Loop Callback"""
-        t = datetime.now().strftime('%H:%M:%S')
-        start = perf_counter()
         if self.aircraft_detected and self.pilot_id:
+            # read datarefs only once per loop
+            at_gate = self.at_gate
             if not self.flight_started:
-                if not self.fp_checked and self.at_gate:
+                if not self.fp_checked and at_gate:
                     # check fp
                     if self.async_task:
                         # we already started a SimBrief async instance
@@ -1165,46 +1433,59 @@ class PythonInterface(object):
                                 self.details_message = "An unknown error occurred"
                                 xp.log(f" *** Unmanaged error in async task {self.async_task.pid}: {self.async_task.result}")
                             else:
-                                # result: {error, request_id, message, fp_info}
-                                error, request_id, self.details_message, fp_info = self.async_task.result.values()
+                                # result: {error, request_id, validators, message, fp_info}
+                                result = self.async_task.result
+                                error, fp_info = result['error'], result['fp_info']
+                                self.details_message = result['message']
                                 if error:
                                     # a managed error occurred
                                     xp.log(f" *** SimBrief error in async task {self.async_task.pid}: {error}")
                                 elif fp_info:
-                                    # we have a valid response
-                                    self.request_id, self.fp_info = request_id, fp_info
+                                    # we have a valid response, keep its validators for the next conditional request
+                                    self.request_id, self.fp_info = result['request_id'], fp_info
+                                    self.fp_info_lines = [f"{k.upper()}: {v}" for k, v in islice(fp_info.items(), 2, None)]
+                                    self.ofp_validators = result['validators']
                                     self.fp_checked = True
+                                    self.ofp_backoff = DEFAULT_SCHEDULE
                                 elif self.fp_info:
                                     # reload was requested, no no OFP found, we do not need to keep checking right now
                                     self.fp_checked = True
+                                    self.ofp_backoff = DEFAULT_SCHEDULE
+                                else:
+                                    # still waiting for the user to create the OFP, ask SimBrief less often
+                                    self.ofp_backoff = min(self.ofp_backoff * 2, OFP_BACKOFF_MAX)
                             # reset download
                             self.async_task = False
-                            self.loop_schedule = DEFAULT_SCHEDULE
+                            self.loop_schedule = self.ofp_backoff
                         else:
-                            # no answer yet, waiting ...
-                            pass
+                            # no answer yet, check again a bit later
+                            self.loop_schedule = min(self.loop_schedule * POLL_BACKOFF, POLL_MAX)
                     else:
                         # we need to start an async task
                         self.details_message = "starting SimBrief query ..."
+                        self.ofp_pilot_id = self.pilot_id
                         self.async_task = Async(
                             SimBrief.run,
                             self.pilot_id,
                             self.plans,
-                            self.request_id
+                            self.request_id,
+                            self.ofp_validators
                         )
                         self.async_task.start()
-                        self.loop_schedule = 3
-                elif not self.flight_started and not self.at_gate:
+                        self.loop_schedule = POLL_MIN
+                elif not self.flight_started and not at_gate:
                     # flight mode, do nothing
                     self.flight_started = True
                     self.details_message = "Have a nice flight!"
                     self.loop_schedule = DEFAULT_SCHEDULE * 10
-            elif self.at_gate:
+            elif at_gate:
                 # look for a new OFP for a turnaround flight
                 self.flight_started = False
                 self.fp_checked = False
                 self.fp_info = {}
+                self.fp_info_lines = []
                 self.details_message = "Looking for a new OFP ..."
+                self.ofp_backoff = DEFAULT_SCHEDULE
                 self.loop_schedule = DEFAULT_SCHEDULE
         else:
             # nothing to do
@@ -1214,15 +1495,14 @@ class PythonInterface(object):
                 self.details_message = "SimBrief PilotID required"
             self.loop_schedule = DEFAULT_SCHEDULE * 5
 
+        # state may have changed, widgets sync on their next message
+        self.details_dirty = self.datis_dirty = True
         return self.loop_schedule
 
     def load_settings(self) -> bool:
         if self.config_file.is_file():
-            # read file
-            with open(self.config_file, 'r', encoding='utf-8') as f:
-                data = f.read()
-            # parse file
-            settings = json.loads(data)
+            # read and parse file, json detects the encoding of raw bytes
+            settings = json.loads(self.config_file.read_bytes())
             self.pilot_id = settings.get('settings').get('pilot_id')
             return True
         else:
@@ -1237,12 +1517,32 @@ class PythonInterface(object):
             xp.setWidgetDescriptor(self.details.pilot_id_input, "")
         else:
             settings = {'settings': {'pilot_id': int(user_id)}}
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(settings, f)
-            # check file
-            self.load_settings()
+            # write a temp file and swap it in, a failed write never leaves a broken settings file
+            tmp = self.config_file.with_name(self.config_file.name + '.tmp')
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(settings, f)
+                os.replace(tmp, self.config_file)
+            except Exception as e:
+                self.details_message = "Error saving settings"
+                xp.log(f" *** Error writing {self.config_file.name}: {e}")
+                return
+            finally:
+                tmp.unlink(missing_ok=True)
+            # file written, no need to read it back
+            self.pilot_id = settings['settings']['pilot_id']
+            self.ofp_backoff = DEFAULT_SCHEDULE
+            if self.pilot_id != self.ofp_pilot_id:
+                # OFP ID, validators and any pending query belong to the previous pilot URL
+                self.request_id = None
+                self.ofp_validators = None
+                if self.async_task:
+                    self.async_task.stop()
+                    self.async_task = False
             self.details_message = 'settings saved'
             self.details.setup_widget(self.pilot_id)
+            # the loop could be idle waiting for a pilot ID, wake it up
+            xp.scheduleFlightLoop(self.loop_id, interval=1)
 
     def XPluginStart(self):
         return self.plugin_name, self.plugin_sig, self.plugin_desc
@@ -1254,16 +1554,33 @@ class PythonInterface(object):
         self.loop = self.loopCallback
         self.loop_id = xp.createFlightLoop(self.loop, phase=1)
         xp.scheduleFlightLoop(self.loop_id, interval=DEFAULT_SCHEDULE)
+        # aircraft could be already loaded
+        self.check_aircraft()
         return 1
 
     def XPluginDisable(self):
         pass
 
+    def XPluginReceiveMessage(self, inFromWho, inMessage, inParam):
+        if inMessage == xp.MSG_PLANE_LOADED and inParam == 0:
+            # user aircraft changed, check it and wake up the loop
+            self.check_aircraft()
+            self.ofp_backoff = DEFAULT_SCHEDULE
+            xp.scheduleFlightLoop(self.loop_id, interval=1)
+        elif inMessage == xp.MSG_AIRPORT_LOADED:
+            # user repositioned, could be at a gate again, no need to wait for the flight mode schedule
+            xp.scheduleFlightLoop(self.loop_id, interval=1)
+
     def XPluginStop(self):
         """Called once by X-Plane on quit (or when plugins are exiting as part of reload)"""
 
         # kill loop
         xp.destroyFlightLoop(self.loop_id)
+        # skip async tasks not started yet, never wait for running ones on the sim thread
+        for task in (self.async_task, self.async_datis):
+            if task:
+                task.stop()
+        Async.shutdown()
         # destroy widgets
         if self.details:
             self.details.destroy()
@@ -1273,6 +1590,8 @@ class PythonInterface(object):
         self.OFPReloadCMD.destroy()
         self.detailsWindowCMD.destroy()
         self.datisWindowCMD.destroy()
+        # close HTTP connections
+        session.close()
         # destroy menu
         xp.destroyMenu(self.main_menu)
         xp.log("flightloop, widget, commands, menu destroyed, exiting ...")